@@ -42,6 +42,19 @@ module_configuration = [
         "mandatory": True,
         "type": "bool"
     },
+    {
+        "param_name": "vt_max_rate",
+        "param_human_name": "VT max requests per minute",
+        "param_description": "Maximum number of requests per minute sent to VT with this key, by each IRIS worker "
+                             "process. With several workers, the total rate can reach this value times the "
+                             "number of workers. 0 means no limit. "
+                             "If empty, public keys are limited to 4 requests per minute and premium keys are "
+                             "not limited. Requests above the limit wait in the hook worker, so a large manual "
+                             "trigger can take several minutes to complete",
+        "default": None,
+        "mandatory": False,
+        "type": "int"
+    },
     {
         "param_name": "vt_manual_hook_enabled",
         "param_human_name": "Manual triggers on IOCs",
@@ -38,6 +38,22 @@ class IrisVTInterface(IrisModuleInterface):
     _module_configuration = interface_conf.module_configuration
     _module_type = IrisModuleTypes.module_processor
 
+    # IOC types handled by the module, with the kind of VT report and the handler to use
+    _DISPATCH = {
+        'ip-any': ('ip', VtHandler.handle_vt_ip),
+        'ip-dst': ('ip', VtHandler.handle_vt_ip),
+        'ip-dst|port': ('ip', VtHandler.handle_vt_ip),
+        'ip-src': ('ip', VtHandler.handle_vt_ip),
+        'ip-src|port': ('ip', VtHandler.handle_vt_ip),
+        'domain': ('domain', VtHandler.handle_vt_domain),
+        'domain|ip': ('domain', VtHandler.handle_vt_domain),
+        'md5': ('hash', VtHandler.handle_vt_hash),
+        'sha1': ('hash', VtHandler.handle_vt_hash),
+        'sha224': ('hash', VtHandler.handle_vt_hash),
+        'sha256': ('hash', VtHandler.handle_vt_hash),
+        'sha512': ('hash', VtHandler.handle_vt_hash)
+    }
+
     def register_hooks(self, module_id: int):
         """
         Registers all the hooks
@@ -47,40 +63,25 @@ class IrisVTInterface(IrisModuleInterface):
         """
         self.module_id = module_id
         module_conf = self.module_dict_conf
-        if module_conf.get('vt_on_create_hook_enabled'):
-            status = self.register_to_hook(module_id, iris_hook_name='on_postload_ioc_create')
-            if status.is_failure():
-                self.log.error(status.get_message())
-                self.log.error(status.get_data())
 
-            else:
-                self.log.info("Successfully registered on_postload_ioc_create hook")
-        else:
-            self.deregister_from_hook(module_id=self.module_id, iris_hook_name='on_postload_ioc_create')
+        hooks = [
+            ('vt_on_create_hook_enabled', 'on_postload_ioc_create', {}),
+            ('vt_on_update_hook_enabled', 'on_postload_ioc_update', {}),
+            ('vt_manual_hook_enabled', 'on_manual_trigger_ioc', {'manual_hook_name': 'Get VT insight'})
+        ]
 
-        if module_conf.get('vt_on_update_hook_enabled'):
-            status = self.register_to_hook(module_id, iris_hook_name='on_postload_ioc_update')
-            if status.is_failure():
-                self.log.error(status.get_message())
-                self.log.error(status.get_data())
-
-            else:
-                self.log.info("Successfully registered on_postload_ioc_update hook")
-        else:
-            self.deregister_from_hook(module_id=self.module_id, iris_hook_name='on_postload_ioc_update')
+        for conf_key, hook_name, hook_kwargs in hooks:
+            if not module_conf.get(conf_key):
+                self.deregister_from_hook(module_id=self.module_id, iris_hook_name=hook_name)
+                continue
 
-        if module_conf.get('vt_manual_hook_enabled'):
-            status = self.register_to_hook(module_id, iris_hook_name='on_manual_trigger_ioc',
-                                           manual_hook_name='Get VT insight')
+            status = self.register_to_hook(module_id, iris_hook_name=hook_name, **hook_kwargs)
             if status.is_failure():
                 self.log.error(status.get_message())
                 self.log.error(status.get_data())
 
             else:
-                self.log.info("Successfully registered on_manual_trigger_ioc hook")
-
-        else:
-            self.deregister_from_hook(module_id=self.module_id, iris_hook_name='on_manual_trigger_ioc')
+                self.log.info(f"Successfully registered {hook_name} hook")
 
     def hooks_handler(self, hook_name: str, hook_ui_name: str, data: any):
         """
@@ -94,20 +95,32 @@ class IrisVTInterface(IrisModuleInterface):
 
         self.log.info(f'Received {hook_name}')
         if hook_name in ['on_postload_ioc_create', 'on_postload_ioc_update', 'on_manual_trigger_ioc']:
-            status = self._handle_ioc(data=data)
+            # Manual triggers are explicit refresh requests, so they never use cached reports
+            status = self._handle_ioc(data=data, use_cache=hook_name != 'on_manual_trigger_ioc')
 
         else:
             self.log.critical(f'Received unsupported hook {hook_name}')
-            return InterfaceStatus.I2Error(data=data, logs=list(self.message_queue))
+            return InterfaceStatus.I2Error(data=data, logs=self._drain_logs())
 
         if status.is_failure():
             self.log.error(f"Encountered error processing hook {hook_name}")
-            return InterfaceStatus.I2Error(data=data, logs=list(self.message_queue))
+            return InterfaceStatus.I2Error(data=data, logs=self._drain_logs())
 
         self.log.info(f"Successfully processed hook {hook_name}")
-        return InterfaceStatus.I2Success(data=data, logs=list(self.message_queue))
+        return InterfaceStatus.I2Success(data=data, logs=self._drain_logs())
+
+    def _drain_logs(self) -> list:
+        """
+        Returns the messages logged so far and empties the queue, so each hook only
+        returns the logs it produced
 
-    def _handle_ioc(self, data) -> InterfaceStatus.IIStatus:
+        :return: List of log messages
+        """
+        logs = list(self.message_queue)
+        self.message_queue.clear()
+        return logs
+
+    def _handle_ioc(self, data, use_cache=True) -> InterfaceStatus.IIStatus:
         """
         Handle the IOC data the module just received. The module registered
         to on_postload hooks, so it receives instances of IOC object.
@@ -115,30 +128,39 @@ class IrisVTInterface(IrisModuleInterface):
         be modified safely.
 
         :param data: Data associated to the hook, here IOC object
+        :param use_cache: Whether VT reports can be served from the report cache
         :return: IIStatus
         """
 
-        vt_handler = VtHandler(mod_config=self.module_dict_conf,
-                               server_config=self.server_dict_conf,
-                               logger=self.log)
-
         in_status = InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeNoError)
 
+        to_process = []
         for element in data:
             # Check that the IOC we receive is of type the module can handle and dispatch
-            if 'ip-' in element.ioc_type.type_name:
-                status = vt_handler.handle_vt_ip(ioc=element)
-                in_status = InterfaceStatus.merge_status(in_status, status)
+            dispatch = self._DISPATCH.get(element.ioc_type.type_name)
+            if dispatch is None:
+                self.log.error(f'IOC type {element.ioc_type.type_name} not handled by VT module. Skipping')
+                continue
 
-            elif 'domain' in element.ioc_type.type_name:
-                status = vt_handler.handle_vt_domain(ioc=element)
-                in_status = InterfaceStatus.merge_status(in_status, status)
+            kind, handler = dispatch
+            to_process.append((element, kind, handler))
 
-            elif element.ioc_type.type_name in ['md5', 'sha1', 'sha224', 'sha256', 'sha512']:
-                status = vt_handler.handle_vt_hash(ioc=element)
-                in_status = InterfaceStatus.merge_status(in_status, status)
+        if not to_process:
+            return in_status(data=data)
 
-            else:
-                self.log.error(f'IOC type {element.ioc_type.type_name} not handled by VT module. Skipping')
+        vt_handler = VtHandler(mod_config=self.module_dict_conf,
+                               server_config=self.server_dict_conf,
+                               logger=self.log,
+                               use_cache=use_cache)
+
+        # Several IOCs received at once, fetch their reports concurrently beforehand
+        reports = {}
+        if len(to_process) > 1:
+            reports = vt_handler.prefetch_reports([(kind, element.ioc_value) for element, kind, _ in to_process])
+
+        # IOCs are attached to the hook's SQLAlchemy session, so they are updated sequentially
+        for element, kind, handler in to_process:
+            status = handler(vt_handler, ioc=element, report=reports.get((kind, element.ioc_value)))
+            in_status = InterfaceStatus.merge_status(in_status, status)
 
         return in_status(data=data)
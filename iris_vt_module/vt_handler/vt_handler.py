@@ -17,9 +17,12 @@
 #  along with this program; if not, write to the Free Software Foundation,
 #  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import logging
+import threading
+import time
 import traceback
-
-from virus_total_apis import PublicApi, PrivateApi
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 from iris_interface.IrisModuleInterface import IrisPipelineTypes, IrisModuleInterface, IrisModuleTypes
 import iris_interface.IrisInterfaceStatus as InterfaceStatus
@@ -28,17 +31,163 @@ from app.datamgmt.manage.manage_attribute_db import add_tab_attribute_field
 from iris_vt_module.vt_handler.vt_helper import gen_domain_report_from_template, gen_ip_report_from_template, \
     get_detected_urls_ratio, gen_hash_report_from_template
 
+# VT API instances, shared across hooks and keyed by (is_premium, api_key, proxies)
+_vt_instances = {}
+
+# Default rate limit of public keys, in requests per minute
+PUBLIC_API_MAX_RATE = 4
+
+# Rate limiting windows, shared across the hooks of a worker process and keyed by API key
+RATE_LIMIT_PERIOD = 60
+_rate_windows = {}
+_rate_windows_lock = threading.Lock()
+
+
+@dataclass
+class _RateWindow:
+    max_rate: int
+    sent: deque
+    lock: threading.Lock
+
+    def acquire(self):
+        """
+        Waits until a request can be sent without exceeding max_rate requests
+        over any RATE_LIMIT_PERIOD seconds, and records it
+        """
+        with self.lock:
+            now = time.monotonic()
+            while self.sent and now - self.sent[0] >= RATE_LIMIT_PERIOD:
+                self.sent.popleft()
+
+            if len(self.sent) >= self.max_rate:
+                time.sleep(self.sent[0] + RATE_LIMIT_PERIOD - now)
+                self.sent.popleft()
+                now = time.monotonic()
+
+            self.sent.append(now)
+
+
+def _get_rate_window(api_key, max_rate):
+    """
+    Returns the rate limiting window of an API key, allowing max_rate requests per minute
+
+    :param api_key: VT API key
+    :param max_rate: Number of requests allowed per minute
+    :return: _RateWindow
+    """
+    with _rate_windows_lock:
+        window = _rate_windows.get(api_key)
+        if window is None or window.max_rate != max_rate:
+            window = _RateWindow(max_rate=max_rate, sent=deque(), lock=threading.Lock())
+            _rate_windows[api_key] = window
+
+        return window
+
+
+# Valid VT reports, shared across hooks and keyed by (api_key, is_premium, kind, value)
+REPORT_CACHE_SIZE = 4096
+REPORT_CACHE_TTL = 3600
+_report_cache = OrderedDict()
+_report_cache_lock = threading.Lock()
+
+
+def _get_cached_report(cache_key):
+    """
+    Returns a copy of a cached VT report if it is present and not expired
+
+    :param cache_key: Key of the report, as returned by VtHandler._report_cache_key
+    :return: VT report or None
+    """
+    with _report_cache_lock:
+        entry = _report_cache.get(cache_key)
+        if entry is None:
+            return None
+
+        expires, report = entry
+        if expires < time.monotonic():
+            del _report_cache[cache_key]
+            return None
+
+        _report_cache.move_to_end(cache_key)
+
+    # Report generation adds keys to the report, so never hand out the cached dict itself
+    return dict(report)
+
+
+def _cache_report(cache_key, report):
+    """
+    Stores a VT report in the cache, evicting the least recently used one if the cache is full
+
+    :param cache_key: Key of the report, as returned by VtHandler._report_cache_key
+    :param report: VT report
+    :return: Nothing
+    """
+    with _report_cache_lock:
+        _report_cache[cache_key] = (time.monotonic() + REPORT_CACHE_TTL, dict(report))
+        _report_cache.move_to_end(cache_key)
+        while len(_report_cache) > REPORT_CACHE_SIZE:
+            _report_cache.popitem(last=False)
+
+
+# Thread pools used to prefetch reports, keyed by number of workers
+MAX_PREFETCH_WORKERS = 8
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _get_prefetch_workers(max_rate):
+    """
+    Returns the number of threads worth using to prefetch reports at the allowed rate
+
+    :param max_rate: Number of requests allowed per minute, 0 meaning no limit
+    :return: int
+    """
+    if max_rate <= 0:
+        return MAX_PREFETCH_WORKERS
+
+    return min(max_rate // 60, MAX_PREFETCH_WORKERS)
+
+
+def _get_executor(max_workers):
+    """
+    Returns a shared thread pool with the given number of workers
+
+    :param max_workers: Number of threads of the pool
+    :return: ThreadPoolExecutor
+    """
+    with _executors_lock:
+        executor = _executors.get(max_workers)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='iris_vt_module')
+            _executors[max_workers] = executor
+
+        return executor
+
 
 class VtHandler(object):
-    def __init__(self, mod_config, server_config, logger):
+    __slots__ = ('mod_config', 'server_config', '_vt', 'log', 'use_cache')
+
+    def __init__(self, mod_config, server_config, logger, use_cache=True):
         self.mod_config = mod_config
         self.server_config = server_config
-        self.vt = self.get_vt_instance()
+        self._vt = None
         self.log = logger
+        self.use_cache = use_cache
+
+    @property
+    def vt(self):
+        """
+        VT API instance, only built once a report actually needs to be fetched
+        """
+        if self._vt is None:
+            self._vt = self.get_vt_instance()
+
+        return self._vt
 
     def get_vt_instance(self):
         """
-        Returns an VT API instance depending if the key is premium or not
+        Returns an VT API instance depending if the key is premium or not.
+        Instances are cached so the same client is reused across hooks.
 
         :return: VT Instance
         """
@@ -52,17 +201,127 @@ class VtHandler(object):
         if self.server_config.get('https_proxy'):
             proxies['http'] = self.server_config.get('HTTP_PROXY')
 
-        if is_premium:
-            return PrivateApi(api_key, proxies=proxies)
+        cache_key = (bool(is_premium), api_key, tuple(sorted(proxies.items())))
+        vt = _vt_instances.get(cache_key)
+        if vt is None:
+            # Imported here so the VT API stack is only loaded once an IOC needs it
+            from virus_total_apis import PublicApi, PrivateApi
+
+            if is_premium:
+                vt = PrivateApi(api_key, proxies=proxies)
+            else:
+                vt = PublicApi(api_key, proxies=proxies)
+
+            _vt_instances[cache_key] = vt
+
+        return vt
+
+    def _get_max_rate(self):
+        """
+        Returns the number of requests per minute allowed for the key, 0 meaning no limit.
+        Defaults to the public quota for public keys and to no limit for premium keys.
+
+        :return: int
+        """
+        max_rate = self.mod_config.get('vt_max_rate')
+        if max_rate is None or max_rate == '':
+            return 0 if self.mod_config.get('vt_key_is_premium') else PUBLIC_API_MAX_RATE
+
+        try:
+            return max(0, int(max_rate))
+
+        except (TypeError, ValueError):
+            self.log.error(f'Invalid VT max rate {max_rate}. Requests are not rate limited')
+            return 0
+
+    def _report_cache_key(self, kind, value):
+        """
+        Returns the key of a report in the report cache. It includes the API key and its type,
+        so reports fetched with another key are never served
+
+        :param kind: Type of report - ip, domain or hash
+        :param value: Value looked up
+        :return: Tuple
+        """
+        return (self.mod_config.get('vt_api_key'), bool(self.mod_config.get('vt_key_is_premium')), kind, value)
+
+    def _fetch_report(self, kind, value):
+        """
+        Fetches a VT report, waiting for the configured rate limit if needed.
+        Valid reports are cached so repeated lookups of an IOC don't hit VT again. The cache
+        is only read if use_cache is set, but fresh reports are always stored.
+
+        :param kind: Type of report to fetch - ip, domain or hash
+        :param value: Value to lookup
+        :return: VT report
+        """
+        cache_key = self._report_cache_key(kind, value)
+        if self.use_cache:
+            report = _get_cached_report(cache_key)
+            if report is not None:
+                self.log.info(f'Using cached VT report for {value}')
+                return report
+
+        max_rate = self._get_max_rate()
+        if max_rate > 0:
+            _get_rate_window(self.mod_config.get('vt_api_key'), max_rate).acquire()
+
+        if kind == 'ip':
+            report = self.vt.get_ip_report(value)
+
+        elif kind == 'domain':
+            report = self.vt.get_domain_report(value)
+
         else:
-            return PublicApi(api_key, proxies=proxies)
+            report = self.vt.get_file_report(value)
+
+        # Only complete reports are cached, not unknown IOCs (0) nor scans still queued (-2)
+        results = report.get('results')
+        if results and results.get('response_code') == 1:
+            _cache_report(cache_key, report)
+
+        return report
+
+    def _prefetch_report(self, lookup):
+        """
+        Fetches a report from a prefetch thread, logging errors instead of raising them
+
+        :param lookup: Tuple (kind, value) to fetch
+        :return: VT report, empty if the request failed
+        """
+        kind, value = lookup
+        try:
+            return self._fetch_report(kind, value)
+
+        except Exception:
+            self.log.error(traceback.format_exc())
+            # Empty report, so the IOC fails validation instead of being fetched again
+            return {}
+
+    def prefetch_reports(self, lookups):
+        """
+        Fetches several VT reports concurrently, before the IOCs are processed.
+        The requests still go through the rate limiter. Nothing is fetched if the allowed
+        rate is too low to run requests in parallel.
+
+        :param lookups: List of (kind, value) to fetch
+        :return: Dict of {(kind, value): report}
+        """
+        lookups = list(dict.fromkeys(lookups))
+        max_workers = _get_prefetch_workers(self._get_max_rate())
+        if len(lookups) < 2 or max_workers < 2:
+            return {}
+
+        self.log.info(f'Prefetching {len(lookups)} VT reports')
+        executor = _get_executor(max_workers)
+        return dict(zip(lookups, executor.map(self._prefetch_report, lookups)))
 
     def _validate_report(self, report):
         self.log.info(f'VT report fetched.')
         results = report.get('results')
         if not results:
             self.log.error(f'Unable to get report. Is the API key valid ?')
-            return InterfaceStatus.I2Error
+            return InterfaceStatus.I2Error()
 
         if results.get('response_code') == 0:
             self.log.error(f'Got invalid feedback from VT :: {results.get("verbose_msg")}')
@@ -104,16 +363,18 @@ class VtHandler(object):
                 if f'vt:malicious' in ioc.ioc_tags.split(','):
                     ioc.ioc_tags = ioc.ioc_tags.replace('vt:malicious', '').replace(',,', ',')
 
-    def handle_vt_domain(self, ioc):
+    def handle_vt_domain(self, ioc, report=None):
         """
         Handles an IOC of type domain and adds VT insights
 
         :param ioc: IOC instance
+        :param report: VT report already fetched for the IOC, fetched here if None
         :return: IIStatus
         """
 
-        self.log.info(f'Getting domain report for {ioc.ioc_value}')
-        report = self.vt.get_domain_report(ioc.ioc_value)
+        if report is None:
+            self.log.info(f'Getting domain report for {ioc.ioc_value}')
+            report = self._fetch_report('domain', ioc.ioc_value)
 
         status = self._validate_report(report)
         if not status: return status
@@ -125,8 +386,12 @@ class VtHandler(object):
 
         if self.mod_config.get('vt_domain_add_whois_as_desc') is True:
             if "WHOIS" not in ioc.ioc_description:
-                self.log.info('Adding WHOIS information to IOC description')
-                ioc.ioc_description = f"{ioc.ioc_description}\n\nWHOIS\n {results.get('whois')}"
+                whois = results.get('whois')
+                if whois:
+                    self.log.info('Adding WHOIS information to IOC description')
+                    ioc.ioc_description = ''.join((ioc.ioc_description, '\n\nWHOIS\n ', whois))
+                else:
+                    self.log.info('No WHOIS in VT report - skipping')
 
             else:
                 self.log.info('Skipped adding WHOIS. Information already present')
@@ -136,7 +401,7 @@ class VtHandler(object):
         if self.mod_config.get('vt_domain_add_subdomain_as_desc') is True:
 
             if "Subdomains" not in ioc.ioc_description:
-                if report.get('results').get('subdomains'):
+                if results.get('subdomains'):
                     subd_data = [f"- {subd}\n" for subd in results.get('subdomains')]
                     self.log.info('Adding subdomains information to IOC description')
                     ioc.ioc_description = f"{ioc.ioc_description}\n\nSubdomains\n{subd_data}"
@@ -171,17 +436,17 @@ class VtHandler(object):
 
         return InterfaceStatus.I2Success()
 
-    def handle_vt_ip(self, ioc):
+    def handle_vt_ip(self, ioc, report=None):
         """
         Handles an IOC of type IP and adds VT insights
 
         :param ioc: IOC instance
+        :param report: VT report already fetched for the IOC, fetched here if None
         :return: IIStatus
         """
-        vt = self.get_vt_instance()
-
-        self.log.info(f'Getting IP report for {ioc.ioc_value}')
-        report = vt.get_ip_report(ioc.ioc_value)
+        if report is None:
+            self.log.info(f'Getting IP report for {ioc.ioc_value}')
+            report = self._fetch_report('ip', ioc.ioc_value)
 
         status = self._validate_report(report)
         if not status: return status
@@ -199,13 +464,14 @@ class VtHandler(object):
             if asn is None:
                 self.log.info('ASN was nul - skipping')
 
-            if ioc.ioc_tags is None:
-                ioc.ioc_tags = ""
-
-            if f'ASN:{asn}' not in ioc.ioc_tags.split(','):
-                ioc.ioc_tags = f"{ioc.ioc_tags},ASN:{asn}"
             else:
-                self.log.info('ASN already tagged for this IOC. Skipping')
+                if ioc.ioc_tags is None:
+                    ioc.ioc_tags = ""
+
+                if f'ASN:{asn}' not in ioc.ioc_tags.split(','):
+                    ioc.ioc_tags = ','.join((ioc.ioc_tags, f'ASN:{asn}'))
+                else:
+                    self.log.info('ASN already tagged for this IOC. Skipping')
 
         if self.mod_config.get('vt_report_as_attribute') is True:
             self.log.info('Adding new attribute VT IP Report to IOC')
@@ -231,17 +497,17 @@ class VtHandler(object):
 
         return InterfaceStatus.I2Success("Successfully processed IP")
 
-    def handle_vt_hash(self, ioc):
+    def handle_vt_hash(self, ioc, report=None):
         """
         Handles an IOC of type hash and adds VT insights
 
         :param ioc: IOC instance
+        :param report: VT report already fetched for the IOC, fetched here if None
         :return: IIStatus
         """
-        vt = self.get_vt_instance()
-
-        self.log.info(f'Getting hash report for {ioc.ioc_value}')
-        report = vt.get_file_report(ioc.ioc_value)
+        if report is None:
+            self.log.info(f'Getting hash report for {ioc.ioc_value}')
+            report = self._fetch_report('hash', ioc.ioc_value)
 
         status = self._validate_report(report)
         if not status: return status